@@ -1,7 +1,10 @@
 import os
 
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _lazy
 
 from kitsune.sumo.models import ModelBase
@@ -9,6 +12,8 @@ from kitsune.sumo.urlresolvers import reverse
 
 
 HOT_TOPIC_SLUG = 'hot'
+PRODUCT_IDS_BY_CODENAME_CACHE_KEY = 'products:ids_by_codename'
+PRODUCT_IDS_BY_CODENAME_CACHE_TIMEOUT = 5 * 60
 
 
 class Product(ModelBase):
@@ -68,6 +73,25 @@ class Product(ModelBase):
         return reverse('products.product', kwargs={'slug': self.slug})
 
 
+def get_product_ids_by_codename():
+    """Return a dict mapping each product codename to its product ids."""
+    product_ids = cache.get(PRODUCT_IDS_BY_CODENAME_CACHE_KEY)
+    if product_ids is None:
+        product_ids = {}
+        for codename, pk in Product.objects.values_list('codename', 'pk'):
+            product_ids.setdefault(codename, []).append(pk)
+        cache.set(PRODUCT_IDS_BY_CODENAME_CACHE_KEY, product_ids,
+                  PRODUCT_IDS_BY_CODENAME_CACHE_TIMEOUT)
+    return product_ids
+
+
+@receiver([post_save, post_delete], sender=Product,
+          dispatch_uid='product_clear_ids_by_codename')
+def clear_product_ids_by_codename(sender, **kwargs):
+    """Drop the cached codename map once the product change is committed."""
+    transaction.on_commit(lambda: cache.delete(PRODUCT_IDS_BY_CODENAME_CACHE_KEY))
+
+
 # Note: This is the "new" Topic class
 class Topic(ModelBase):
     title = models.CharField(max_length=255, db_index=True)
@@ -1,9 +1,40 @@
+from mock import patch
 from nose.tools import eq_
 
+from kitsune.products.models import get_product_ids_by_codename
 from kitsune.products.tests import ProductFactory, TopicFactory
 from kitsune.sumo.tests import TestCase
 
 
+class ProductIdsByCodenameTests(TestCase):
+
+    @patch('kitsune.products.models.transaction.on_commit')
+    def test_cache_cleared_on_commit(self, on_commit_mock):
+        """Verify the codename map is only dropped once the change commits."""
+        p1 = ProductFactory(codename='foo')
+        eq_(get_product_ids_by_codename().get('foo'), [p1.id])
+
+        ProductFactory(codename='foo')
+        # Not committed yet, the cached map is still served
+        eq_(get_product_ids_by_codename().get('foo'), [p1.id])
+
+        on_commit_mock.call_args[0][0]()
+        eq_(len(get_product_ids_by_codename().get('foo')), 2)
+
+    # TestCase never commits, so run on_commit callbacks right away.
+    @patch('kitsune.products.models.transaction.on_commit', lambda func: func())
+    def test_product_ids_by_codename(self):
+        """Verify the codename map is refreshed when products change."""
+        p1 = ProductFactory(codename='foo')
+        eq_(get_product_ids_by_codename().get('foo'), [p1.id])
+
+        p2 = ProductFactory(codename='foo')
+        eq_(sorted(get_product_ids_by_codename().get('foo')), sorted([p1.id, p2.id]))
+
+        p1.delete()
+        eq_(get_product_ids_by_codename().get('foo'), [p2.id])
+
+
 class TopicModelTests(TestCase):
 
     def test_path(self):
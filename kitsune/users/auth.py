@@ -1,22 +1,68 @@
+import hashlib
 import logging
+from concurrent import futures
 
 import requests
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse as django_reverse
 from django.db import transaction
+from django.utils.lru_cache import lru_cache
 from django.utils.translation import ugettext as _
 from mozilla_django_oidc.auth import OIDCAuthenticationBackend
+from requests.adapters import HTTPAdapter
+from requests.compat import cookielib
+from urllib3.util.retry import Retry
 
-from kitsune.products.models import Product
+from kitsune.products.models import get_product_ids_by_codename
 from kitsune.sumo.urlresolvers import reverse
 from kitsune.users.models import Profile
 from kitsune.users.utils import add_to_contributors, get_oidc_fxa_setting
 
 log = logging.getLogger('k.users')
 
+# Profile and subscription state are stable for the lifetime of an access token.
+FXA_USERINFO_CACHE_TIMEOUT = 30
+FXA_SUBSCRIPTIONS_CACHE_TIMEOUT = 60
+
+# (connect, read) timeouts in seconds for requests to the FxA subscription endpoint.
+FXA_REQUEST_TIMEOUT = (2, 3)
+# Retry connection failures and gateway errors once. Read timeouts are not
+# retried: a slow FxA would only be hit again after the caller gave up.
+# Retry-After is ignored so a server can't park executor threads in sleep().
+FXA_REQUEST_RETRIES = 1
+# Seconds to wait for the subscription fetch, sized to cover the connect and read
+# timeouts of every attempt. The read timeout applies to each socket read, not
+# to the whole response, so a trickling response can still outlive the wait.
+FXA_SUBSCRIPTIONS_TIMEOUT = sum(FXA_REQUEST_TIMEOUT) * (FXA_REQUEST_RETRIES + 1)
+
+# Reuse connections to the FxA subscription endpoint across logins. The session
+# is shared by all users, so it must never store cookies.
+fxa_session = requests.Session()
+fxa_session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+fxa_session.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=FXA_REQUEST_RETRIES, read=0,
+                      status_forcelist=[502, 503, 504],
+                      respect_retry_after_header=False)))
+# Fetch subscriptions concurrently with the profile endpoint request.
+fxa_executor = futures.ThreadPoolExecutor(max_workers=8)
+
+
+def hash_access_token(access_token):
+    """Return a digest of an access token suitable for cache keys."""
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=1)
+def oidc_callback_path():
+    """Return the path of the admin OIDC callback, resolved once per process."""
+    return django_reverse('oidc_authentication_callback')
+
 
 class SumoOIDCAuthBackend(OIDCAuthenticationBackend):
 
@@ -26,7 +72,7 @@ class SumoOIDCAuthBackend(OIDCAuthenticationBackend):
         # If the request has the /fxa/callback/ path then probably there is a login
         # with Firefox Accounts. In this case just return None and let
         # the FxA backend handle this request.
-        if request and not request.path == django_reverse('oidc_authentication_callback'):
+        if request and not request.path == oidc_callback_path():
             return None
 
         return super(SumoOIDCAuthBackend, self).authenticate(request, **kwargs)
@@ -46,27 +92,28 @@ class FXAAuthBackend(OIDCAuthenticationBackend):
         """Override create user method to mark the profile as migrated."""
 
         user = super(FXAAuthBackend, self).create_user(claims)
-        # Create a user profile for the user and populate it with data from
-        # Firefox Accounts
-        profile, _ = Profile.objects.get_or_create(user=user)
-        profile.is_fxa_migrated = True
-        profile.fxa_uid = claims.get('uid')
-        profile.fxa_avatar = claims.get('avatar', '')
-        profile.name = claims.get('displayName', '')
         subscriptions = claims.get('subscriptions', [])
         # Let's get the first element even if it's an empty string
         # A few assertions return a locale of None so we need to default to empty string
         fxa_locale = (claims.get('locale', '') or '').split(',')[0]
-        if fxa_locale in settings.SUMO_LANGUAGES:
-            profile.locale = fxa_locale
-        else:
-            profile.locale = settings.LANGUAGE_CODE
+        if fxa_locale not in settings.SUMO_LANGUAGES:
+            fxa_locale = settings.LANGUAGE_CODE
 
-        profile.save()
-        # User subscription information
-        products = Product.objects.filter(codename__in=subscriptions)
-        profile.products.clear()
-        profile.products.add(*products)
+        # Create a user profile for the user and populate it with data from
+        # Firefox Accounts. Nothing creates profiles on User save, so the
+        # user we just created can't have one yet.
+        profile = Profile.objects.create(
+            user=user,
+            is_fxa_migrated=True,
+            fxa_uid=claims.get('uid'),
+            fxa_avatar=claims.get('avatar', ''),
+            name=claims.get('displayName', ''),
+            locale=fxa_locale)
+        # User subscription information. The profile is new, so there is
+        # nothing to diff against.
+        product_ids = self._get_subscribed_product_ids(subscriptions)
+        if product_ids:
+            profile.products.add(*product_ids)
 
         # This is a new sumo profile, redirect to the edit profile page
         self.request.session['oidc_login_next'] = reverse('users.edit_my_profile')
@@ -78,23 +125,29 @@ class FXAAuthBackend(OIDCAuthenticationBackend):
 
         return user
 
+    def _get_subscribed_product_ids(self, subscriptions):
+        """Return the ids of the products matching the FxA subscription codenames."""
+        product_ids = get_product_ids_by_codename()
+        return set(pk for codename in set(subscriptions)
+                   for pk in product_ids.get(codename, []))
+
     def filter_users_by_claims(self, claims):
         """Match users by FxA uid or email."""
         fxa_uid = claims.get('uid')
         user_model = get_user_model()
-        users = user_model.objects.none()
 
         # something went terribly wrong. Return None
         if not fxa_uid:
             log.warning(u'Failed to get Firefox Account UID.')
-            return users
+            return user_model.objects.none()
 
         # A existing user is attempting to connect a Firefox Account to the SUMO profile
         # NOTE: this section will be dropped when the migration is complete
-        if self.request and self.request.user and self.request.user.is_authenticated():
+        if self.request and self.request.user and self.request.user.is_authenticated:
             return [self.request.user]
 
-        users = user_model.objects.filter(profile__fxa_uid=fxa_uid)
+        # update_user() reads the profile, fetch it along with the user
+        users = user_model.objects.filter(profile__fxa_uid=fxa_uid).select_related('profile')
 
         if not users:
             # We did not match any users so far. Let's call the super method
@@ -102,30 +155,62 @@ class FXAAuthBackend(OIDCAuthenticationBackend):
             users = super(FXAAuthBackend, self).filter_users_by_claims(claims)
         return users
 
-    def get_userinfo(self, access_token, id_token, payload):
-        """Return user details and subscription information dictionary."""
-
-        user_info = super(FXAAuthBackend, self).get_userinfo(access_token, id_token, payload)
-
-        if not settings.FXA_OP_SUBSCRIPTION_ENDPOINT:
-            return user_info
-
-        # Fetch subscription information
+    def _fetch_subscriptions(self, access_token):
+        """Return the FxA subscriptions of the account, or None if the request fails."""
         try:
-            sub_response = requests.get(
+            sub_response = fxa_session.get(
                 settings.FXA_OP_SUBSCRIPTION_ENDPOINT,
                 headers={
+                    'Accept': 'application/json',
                     'Authorization': 'Bearer {0}'.format(access_token)
                 },
-                verify=self.get_settings('OIDC_VERIFY_SSL', True))
+                verify=self.get_settings('OIDC_VERIFY_SSL', True),
+                timeout=FXA_REQUEST_TIMEOUT)
             sub_response.raise_for_status()
         except requests.exceptions.RequestException:
             log.error('Failed to fetch subscription status', exc_info=True)
-            # if something went wrong, just return whatever the profile endpoint holds
-            return user_info
+            return None
+        return sub_response.json().get('subscriptions', [])
+
+    def _get_profile_userinfo(self, access_token, id_token, payload):
+        """Return the FxA profile endpoint data, cached per access token."""
+        cache_key = 'fxa_userinfo:' + hash_access_token(access_token)
+        user_info = cache.get(cache_key)
+        if user_info is None:
+            user_info = super(FXAAuthBackend, self).get_userinfo(access_token, id_token, payload)
+            cache.set(cache_key, user_info, FXA_USERINFO_CACHE_TIMEOUT)
+        return user_info
+
+    def get_userinfo(self, access_token, id_token, payload):
+        """Return user details and subscription information dictionary."""
+
+        if not settings.FXA_OP_SUBSCRIPTION_ENDPOINT:
+            return self._get_profile_userinfo(access_token, id_token, payload)
+
+        cache_key = 'fxa_sub:' + hash_access_token(access_token)
+        subscriptions = cache.get(cache_key)
+        sub_future = None
+        if subscriptions is None:
+            # Fetch subscription information while the profile endpoint is queried
+            sub_future = fxa_executor.submit(self._fetch_subscriptions, access_token)
+
+        user_info = self._get_profile_userinfo(access_token, id_token, payload)
+
+        if sub_future is not None:
+            try:
+                subscriptions = sub_future.result(timeout=FXA_SUBSCRIPTIONS_TIMEOUT)
+            except futures.TimeoutError:
+                # Don't leave the fetch queued behind newer logins
+                sub_future.cancel()
+                log.error('Timed out fetching subscription status')
+            if subscriptions is None:
+                # if something went wrong, just return whatever the profile endpoint holds
+                return user_info
+            cache.set(cache_key, subscriptions, FXA_SUBSCRIPTIONS_CACHE_TIMEOUT)
+
         # This will override whatever the profile endpoint returns
         # until https://github.com/mozilla/fxa/issues/2463 is fixed
-        user_info['subscriptions'] = sub_response.json().get('subscriptions', [])
+        user_info['subscriptions'] = subscriptions
         return user_info
 
     def update_user(self, user, claims):
@@ -134,19 +219,21 @@ class FXAAuthBackend(OIDCAuthenticationBackend):
         fxa_uid = claims.get('uid')
         email = claims.get('email')
         user_attr_changed = False
+        profile_changes = {}
         # Check if the user has active subscriptions
         subscriptions = claims.get('subscriptions', [])
 
         if not profile.is_fxa_migrated:
             # Check if there is already a Firefox Account with this ID
-            if Profile.objects.filter(fxa_uid=fxa_uid).exists():
+            if (profile.fxa_uid != fxa_uid and
+                    Profile.objects.filter(fxa_uid=fxa_uid).exists()):
                 msg = _('This Firefox Account is already used in another profile.')
                 messages.error(self.request, msg)
                 return None
 
             # If it's not migrated, we can assume that there isn't an FxA id too
-            profile.is_fxa_migrated = True
-            profile.fxa_uid = fxa_uid
+            profile_changes['is_fxa_migrated'] = True
+            profile_changes['fxa_uid'] = fxa_uid
             # This is the first time an existing user is using FxA. Redirect to profile edit
             # in case the user wants to update any settings.
             self.request.session['oidc_login_next'] = reverse('users.edit_my_profile')
@@ -164,20 +251,23 @@ class FXAAuthBackend(OIDCAuthenticationBackend):
             user_attr_changed = True
 
         # Follow avatars from FxA profiles
-        profile.fxa_avatar = claims.get('avatar', '')
-        # User subscription information
-        products = Product.objects.filter(codename__in=subscriptions)
-        profile.products.clear()
-        profile.products.add(*products)
+        fxa_avatar = claims.get('avatar', '')
+        if profile.fxa_avatar != fxa_avatar:
+            profile_changes['fxa_avatar'] = fxa_avatar
 
         # Users can select their own display name.
         if not profile.name:
-            profile.name = claims.get('displayName', '')
+            name = claims.get('displayName', '')
+            if profile.name != name:
+                profile_changes['name'] = name
 
         with transaction.atomic():
             if user_attr_changed:
-                user.save()
-            profile.save()
+                user.save(update_fields=['email'])
+            if profile_changes:
+                profile.update(**profile_changes)
+            # User subscription information. set() only writes the difference.
+            profile.products.set(self._get_subscribed_product_ids(subscriptions))
         return user
 
     def authenticate(self, request, **kwargs):
@@ -186,7 +276,7 @@ class FXAAuthBackend(OIDCAuthenticationBackend):
         # If the request has the /oidc/callback/ path then probably there is a login
         # attempt in the admin interface. In this case just return None and let
         # the OIDC backend handle this request.
-        if request and request.path == django_reverse('oidc_authentication_callback'):
+        if request and request.path == oidc_callback_path():
             return None
 
         return super(FXAAuthBackend, self).authenticate(request, **kwargs)
@@ -1,11 +1,20 @@
+from concurrent import futures
+
+import requests
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
 from django.http import HttpRequest
 from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from mock import Mock, patch
 from nose.tools import eq_, ok_
+from urllib3.response import HTTPResponse
 
+from kitsune.products.tests import ProductFactory
 from kitsune.sumo.tests import TestCase
-from kitsune.users.auth import FXAAuthBackend
+from kitsune.users.auth import (FXA_REQUEST_TIMEOUT, FXAAuthBackend, fxa_session,
+                                hash_access_token)
 from kitsune.users.models import CONTRIBUTOR_GROUP
 from kitsune.users.tests import GroupFactory, UserFactory
 
@@ -20,6 +29,11 @@ class FXAAuthBackendTests(TestCase):
         """Setup class."""
         self.backend = FXAAuthBackend()
 
+    def _get_writes(self, queries):
+        """Return the captured queries that modify data."""
+        return [q['sql'] for q in queries.captured_queries
+                if q['sql'].split(' ', 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE')]
+
     @patch('kitsune.users.auth.messages')
     def test_create_new_profile(self, message_mock):
         """Test that a new profile is created through Firefox Accounts."""
@@ -150,6 +164,25 @@ class FXAAuthBackendTests(TestCase):
         ok_(not User.objects.get(id=user.id).profile.is_fxa_migrated)
         ok_(not User.objects.get(id=user.id).profile.fxa_uid)
 
+    @patch('kitsune.users.auth.messages')
+    def test_migrating_profile_with_same_fxa_uid(self, message_mock):
+        """Test migrating a profile that already holds the claimed FxA uid."""
+        user = UserFactory.create(profile__fxa_uid='my_unique_fxa_id',
+                                  profile__is_fxa_migrated=False)
+        claims = {
+            'uid': 'my_unique_fxa_id',
+            'email': user.email,
+        }
+        request_mock = Mock(spec=HttpRequest)
+        request_mock.session = {}
+        self.backend.claims = claims
+        self.backend.request = request_mock
+        eq_(user, self.backend.update_user(user, claims))
+        ok_(not message_mock.error.called)
+        profile = User.objects.get(id=user.id).profile
+        ok_(profile.is_fxa_migrated)
+        eq_(profile.fxa_uid, 'my_unique_fxa_id')
+
     def test_login_existing_user_by_email(self):
         """Test user filtering by email."""
         user = UserFactory.create(email='bar@example.com')
@@ -252,3 +285,178 @@ class FXAAuthBackendTests(TestCase):
             u'The email used with this Firefox Account is already linked in another profile.'
         )
         eq_(User.objects.get(id=user.id).email, 'bar@example.com')
+
+    @patch('kitsune.users.auth.messages')
+    def test_update_subscriptions(self, message_mock):
+        """Test that subscribed products follow the FxA subscriptions."""
+        ProductFactory.create(codename='foo')
+        ProductFactory.create(codename='bar')
+        user = UserFactory.create(profile__fxa_uid='my_unique_fxa_id',
+                                  profile__is_fxa_migrated=True)
+        claims = {
+            'uid': 'my_unique_fxa_id',
+            'email': user.email,
+            'subscriptions': ['foo']
+        }
+        request_mock = Mock(spec=HttpRequest)
+        request_mock.session = {}
+        self.backend.claims = claims
+        self.backend.request = request_mock
+        self.backend.update_user(user, claims)
+        eq_(['foo'], list(user.profile.products.values_list('codename', flat=True)))
+
+        claims['subscriptions'] = ['bar']
+        self.backend.update_user(user, claims)
+        eq_(['bar'], list(user.profile.products.values_list('codename', flat=True)))
+
+        # Logging in again with the same subscriptions writes nothing
+        with CaptureQueriesContext(connection) as queries:
+            self.backend.update_user(user, claims)
+        eq_([], self._get_writes(queries))
+
+    @patch('kitsune.users.auth.messages')
+    def test_create_user_subscriptions(self, message_mock):
+        """Test that a new profile is subscribed to the claimed products."""
+        ProductFactory.create(codename='foo')
+        ProductFactory.create(codename='bar')
+        claims = {
+            'email': 'bar@example.com',
+            'uid': 'my_unique_fxa_id',
+            'subscriptions': ['foo']
+        }
+        request_mock = Mock(spec=HttpRequest)
+        request_mock.session = {}
+        self.backend.claims = claims
+        self.backend.request = request_mock
+        user = self.backend.create_user(claims)
+        eq_(['foo'], list(user.profile.products.values_list('codename', flat=True)))
+
+    @override_settings(FXA_OP_SUBSCRIPTION_ENDPOINT='https://server.example.com/subscriptions')
+    @patch('kitsune.users.auth.fxa_session')
+    @patch('mozilla_django_oidc.auth.OIDCAuthenticationBackend.get_userinfo')
+    def test_subscriptions_cached_per_access_token(self, get_userinfo_mock, session_mock):
+        """Test that subscription status is fetched once per access token."""
+        get_userinfo_mock.side_effect = lambda *args: {'uid': 'my_unique_fxa_id'}
+        session_mock.get.return_value.json.return_value = {'subscriptions': ['foo']}
+
+        user_info = self.backend.get_userinfo('cached_token', 'id_token', {})
+        eq_(user_info['subscriptions'], ['foo'])
+        user_info = self.backend.get_userinfo('cached_token', 'id_token', {})
+        eq_(user_info['subscriptions'], ['foo'])
+        eq_(session_mock.get.call_count, 1)
+
+    @patch('mozilla_django_oidc.auth.OIDCAuthenticationBackend.get_userinfo')
+    def test_userinfo_cached_per_access_token(self, get_userinfo_mock):
+        """Test that the profile endpoint is queried once per access token."""
+        get_userinfo_mock.return_value = {'uid': 'my_unique_fxa_id'}
+
+        eq_(self.backend.get_userinfo('userinfo_token', 'id_token', {})['uid'],
+            'my_unique_fxa_id')
+        eq_(self.backend.get_userinfo('userinfo_token', 'id_token', {})['uid'],
+            'my_unique_fxa_id')
+        eq_(get_userinfo_mock.call_count, 1)
+
+    @patch('kitsune.users.auth.messages')
+    def test_update_user_writes_only_changes(self, message_mock):
+        """Test that logins only write the profile fields that changed."""
+        user = UserFactory.create(profile__fxa_uid='my_unique_fxa_id',
+                                  profile__is_fxa_migrated=True,
+                                  profile__name='Kenny Bania')
+        claims = {
+            'uid': 'my_unique_fxa_id',
+            'email': user.email,
+            'avatar': 'http://example.com/avatar',
+        }
+        request_mock = Mock(spec=HttpRequest)
+        request_mock.session = {}
+        self.backend.claims = claims
+        self.backend.request = request_mock
+        with CaptureQueriesContext(connection) as queries:
+            self.backend.update_user(user, claims)
+        writes = self._get_writes(queries)
+        eq_(1, len(writes))
+        ok_('users_profile' in writes[0])
+        ok_('fxa_avatar' in writes[0])
+        ok_('bio' not in writes[0])
+
+        # Logging in again with the same claims writes nothing
+        with CaptureQueriesContext(connection) as queries:
+            self.backend.update_user(user, claims)
+        eq_([], self._get_writes(queries))
+        eq_(User.objects.get(id=user.id).profile.fxa_avatar, 'http://example.com/avatar')
+
+    @patch('kitsune.users.auth.messages')
+    def test_email_change_only_updates_email(self, message_mock):
+        """Test that an FxA email change only writes the email column."""
+        user = UserFactory.create(email='foo@example.com',
+                                  profile__fxa_uid='my_unique_fxa_id',
+                                  profile__is_fxa_migrated=True)
+        claims = {
+            'uid': 'my_unique_fxa_id',
+            'email': 'bar@example.com',
+            'avatar': user.profile.fxa_avatar,
+        }
+        request_mock = Mock(spec=HttpRequest)
+        request_mock.session = {}
+        self.backend.claims = claims
+        self.backend.request = request_mock
+        with CaptureQueriesContext(connection) as queries:
+            self.backend.update_user(user, claims)
+        writes = self._get_writes(queries)
+        eq_(1, len(writes))
+        ok_('auth_user' in writes[0])
+        ok_('email' in writes[0])
+        ok_('password' not in writes[0])
+        eq_(User.objects.get(id=user.id).email, 'bar@example.com')
+
+    @override_settings(FXA_OP_SUBSCRIPTION_ENDPOINT='https://server.example.com/subscriptions')
+    @patch('kitsune.users.auth.fxa_executor')
+    @patch('mozilla_django_oidc.auth.OIDCAuthenticationBackend.get_userinfo')
+    def test_subscriptions_fetch_timeout(self, get_userinfo_mock, executor_mock):
+        """Test that a timed out subscription fetch falls back to the profile data."""
+        get_userinfo_mock.return_value = {'uid': 'my_unique_fxa_id'}
+        sub_future = executor_mock.submit.return_value
+        sub_future.result.side_effect = futures.TimeoutError
+
+        user_info = self.backend.get_userinfo('timeout_token', 'id_token', {})
+        eq_(user_info, {'uid': 'my_unique_fxa_id'})
+        ok_(sub_future.cancel.called)
+        ok_(cache.get('fxa_sub:' + hash_access_token('timeout_token')) is None)
+
+    @override_settings(FXA_OP_SUBSCRIPTION_ENDPOINT='https://server.example.com/subscriptions')
+    @patch('kitsune.users.auth.fxa_session')
+    @patch('mozilla_django_oidc.auth.OIDCAuthenticationBackend.get_userinfo')
+    def test_subscriptions_fetch_request(self, get_userinfo_mock, session_mock):
+        """Test the request made to the FxA subscription endpoint."""
+        get_userinfo_mock.return_value = {'uid': 'my_unique_fxa_id'}
+        session_mock.get.return_value.json.return_value = {'subscriptions': ['foo']}
+
+        self.backend.get_userinfo('request_token', 'id_token', {})
+        args, kwargs = session_mock.get.call_args
+        eq_(args, ('https://server.example.com/subscriptions',))
+        eq_(kwargs['timeout'], FXA_REQUEST_TIMEOUT)
+        eq_(kwargs['headers'], {
+            'Accept': 'application/json',
+            'Authorization': 'Bearer request_token'
+        })
+
+    @override_settings(FXA_OP_SUBSCRIPTION_ENDPOINT='https://server.example.com/subscriptions')
+    @patch('kitsune.users.auth.fxa_session')
+    @patch('mozilla_django_oidc.auth.OIDCAuthenticationBackend.get_userinfo')
+    def test_subscriptions_fetch_error(self, get_userinfo_mock, session_mock):
+        """Test that a failed subscription fetch falls back to the profile data."""
+        get_userinfo_mock.return_value = {'uid': 'my_unique_fxa_id'}
+        session_mock.get.side_effect = requests.exceptions.RequestException
+
+        user_info = self.backend.get_userinfo('error_token', 'id_token', {})
+        eq_(user_info, {'uid': 'my_unique_fxa_id'})
+        ok_(cache.get('fxa_sub:' + hash_access_token('error_token')) is None)
+
+    @patch('urllib3.util.retry.time.sleep')
+    def test_subscriptions_retry_ignores_retry_after(self, sleep_mock):
+        """Test that a Retry-After header doesn't put the fetch to sleep."""
+        retry = fxa_session.get_adapter('https://server.example.com/').max_retries
+        response = HTTPResponse(status=503, headers={'Retry-After': '300'})
+        ok_(retry.is_retry('GET', 503, has_retry_after=True))
+        retry.increment('GET', '/subscriptions', response=response).sleep(response)
+        ok_(not sleep_mock.called)